@@ -1,12 +1,19 @@
+import asyncio
 import os
 import logging
-from typing import Optional
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, List, Optional
 
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel, Field
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai import AsyncOpenAI
+from fastembed import TextEmbedding
 import chromadb
+import orjson
+
+from query_cache import QueryCache
 
 
 # ------------------------------------------------------------------
@@ -18,8 +25,14 @@ load_dotenv()
 APP_TITLE = "RAG API (Chroma Cloud + OpenAI)"
 COLLECTION_NAME = "netweb_knowledge_base"
 OPENAI_MODEL = "gpt-4.1-nano"
+EMBEDDING_MODEL = "BAAI/bge-small-en-v1.5"
 TOP_K = 10
 
+HEALTH_CHECK_TIMEOUT = 2  # seconds
+
+CACHE_TTL_SECONDS = 300
+CACHE_MAX_SIZE = 1000
+
 
 # ------------------------------------------------------------------
 # Logging
@@ -60,7 +73,12 @@ validate_env()
 # Clients
 # ------------------------------------------------------------------
 
-openai_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+openai_client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+
+query_cache = QueryCache(
+    ttl_seconds=CACHE_TTL_SECONDS,
+    max_size=CACHE_MAX_SIZE,
+)
 
 
 def get_chroma_client() -> chromadb.CloudClient:
@@ -71,6 +89,46 @@ def get_chroma_client() -> chromadb.CloudClient:
     )
 
 
+def validate_collection(collection: chromadb.Collection) -> None:
+    # ingest.py stamps the collection with the model its vectors came from
+    stored_model = (collection.metadata or {}).get("embedding_model")
+
+    if stored_model != EMBEDDING_MODEL:
+        raise RuntimeError(
+            f"Collection '{COLLECTION_NAME}' was embedded with "
+            f"{stored_model or 'an unrecorded model'}, expected "
+            f"{EMBEDDING_MODEL}. Delete the collection and re-run ingestion."
+        )
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    """
+    Connect to Chroma Cloud and load the local embedding model once
+    at startup, sharing both across requests.
+    """
+    logger.info("Loading embedding model | model=%s", EMBEDDING_MODEL)
+
+    # Same model ingest.py uses for the documents; the first encode
+    # initializes the ONNX session, so do it before serving traffic
+    app.state.embedding_model = TextEmbedding(model_name=EMBEDDING_MODEL)
+    list(app.state.embedding_model.query_embed(["warmup"]))
+
+    logger.info("Connecting to Chroma Cloud")
+
+    app.state.chroma_client = get_chroma_client()
+    app.state.collection = app.state.chroma_client.get_collection(
+        name=COLLECTION_NAME,
+    )
+    validate_collection(app.state.collection)
+
+    logger.info("Chroma collection ready | collection=%s", COLLECTION_NAME)
+
+    yield
+
+    await openai_client.close()
+
+
 # ------------------------------------------------------------------
 # API Models
 # ------------------------------------------------------------------
@@ -87,7 +145,78 @@ class QueryResponse(BaseModel):
 # FastAPI App
 # ------------------------------------------------------------------
 
-app = FastAPI(title=APP_TITLE)
+app = FastAPI(
+    title=APP_TITLE,
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
+)
+
+
+# ------------------------------------------------------------------
+# RAG Pipeline
+# ------------------------------------------------------------------
+
+NO_CONTEXT_ANSWER = "No relevant information found."
+
+
+def embed_query(question: str) -> List[float]:
+    vector = next(iter(app.state.embedding_model.query_embed([question])))
+    return vector.tolist()
+
+
+async def retrieve_context(question: str) -> Optional[str]:
+    # Local ONNX inference is CPU-bound; keep it off the event loop
+    query_embedding = await asyncio.to_thread(embed_query, question)
+
+    # Chroma's client is synchronous; run it off the event loop
+    search_results = await asyncio.to_thread(
+        app.state.collection.query,
+        query_embeddings=[query_embedding],
+        n_results=TOP_K,
+    )
+
+    documents = search_results.get("documents", [[]])[0]
+    if not documents:
+        logger.warning("No relevant documents found")
+        return None
+
+    context = "\n\n".join(documents)
+    # ~4 characters per BPE token; avoids splitting the whole context
+    approx_token_count = len(context) // 4
+
+    logger.info(
+        "Context prepared | chunks=%s approx_tokens=%s",
+        len(documents),
+        approx_token_count,
+    )
+
+    return context
+
+
+# Shared across requests; never mutate
+SYSTEM_MESSAGE: Dict[str, str] = {
+    "role": "system",
+    "content": (
+        "You are a factual assistant. "
+        "Answer strictly using the provided context. "
+        "If the answer is not present, say you don't know."
+    ),
+}
+
+
+def build_messages(context: str, question: str) -> List[Dict[str, str]]:
+    return [
+        SYSTEM_MESSAGE,
+        {
+            "role": "user",
+            "content": f"Context:\n{context}\n\nQuestion: {question}",
+        },
+    ]
+
+
+def sse_event(payload: dict) -> str:
+    # JSON-encode so newlines in the answer don't break SSE framing
+    return f"data: {orjson.dumps(payload).decode()}\n\n"
 
 
 # ------------------------------------------------------------------
@@ -103,53 +232,31 @@ async def query_rag(request: QueryRequest) -> QueryResponse:
     """
     logger.info("Query received")
 
+    cache_key = query_cache.make_key(request.question, TOP_K)
+    cached_answer = query_cache.get(cache_key)
+    if cached_answer is not None:
+        logger.info("Answer served from cache")
+        return QueryResponse(answer=cached_answer)
+
     try:
         # --- Retrieval ---
-        chroma_client = get_chroma_client()
-        collection = chroma_client.get_collection(name=COLLECTION_NAME)
-
-        search_results = collection.query(
-            query_texts=[request.question],
-            n_results=TOP_K,
-        )
-
-        documents = search_results.get("documents", [[]])[0]
-        if not documents:
-            logger.warning("No relevant documents found")
-            return QueryResponse(answer="No relevant information found.")
-
-        context = "\n\n".join(documents)
-        approx_token_count = len(context.split())
-
-        logger.info(
-            "Context prepared | chunks=%s approx_tokens=%s",
-            len(documents),
-            approx_token_count,
-        )
+        context = await retrieve_context(request.question)
+        if context is None:
+            return QueryResponse(answer=NO_CONTEXT_ANSWER)
 
         # --- Generation ---
-        response = openai_client.chat.completions.create(
+        response = await openai_client.chat.completions.create(
             model=OPENAI_MODEL,
-            messages=[
-                {
-                    "role": "system",
-                    "content": (
-                        "You are a factual assistant. "
-                        "Answer strictly using the provided context. "
-                        "If the answer is not present, say you don't know."
-                    ),
-                },
-                {
-                    "role": "user",
-                    "content": f"Context:\n{context}\n\nQuestion: {request.question}",
-                },
-            ],
+            messages=build_messages(context, request.question),
             temperature=0,
         )
 
         answer = response.choices[0].message.content
         logger.info("Answer generated successfully")
 
+        if answer:
+            query_cache.put(cache_key, answer)
+
         return QueryResponse(answer=answer)
 
     except Exception as exc:
@@ -157,6 +264,107 @@ async def query_rag(request: QueryRequest) -> QueryResponse:
         raise HTTPException(status_code=500, detail="Internal server error") from exc
 
 
+@app.post("/query/stream")
+async def query_rag_stream(request: QueryRequest) -> StreamingResponse:
+    """
+    Same flow as /query, but streams the answer as Server-Sent Events.
+
+    Each event is `data: {"delta": "..."}`; the stream ends with
+    `data: [DONE]`, or `data: {"error": "..."}` on failure.
+    """
+    logger.info("Streaming query received")
+
+    cache_key = query_cache.make_key(request.question, TOP_K)
+
+    async def event_stream() -> AsyncIterator[str]:
+        cached_answer = query_cache.get(cache_key)
+        if cached_answer is not None:
+            logger.info("Answer served from cache")
+            yield sse_event({"delta": cached_answer})
+            yield "data: [DONE]\n\n"
+            return
+
+        try:
+            context = await retrieve_context(request.question)
+            if context is None:
+                yield sse_event({"delta": NO_CONTEXT_ANSWER})
+                yield "data: [DONE]\n\n"
+                return
+
+            stream = await openai_client.chat.completions.create(
+                model=OPENAI_MODEL,
+                messages=build_messages(context, request.question),
+                temperature=0,
+                stream=True,
+            )
+
+            parts: List[str] = []
+            async for chunk in stream:
+                if not chunk.choices:
+                    continue
+
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    parts.append(delta)
+                    yield sse_event({"delta": delta})
+
+            logger.info("Answer streamed successfully")
+
+            answer = "".join(parts)
+            if answer:
+                query_cache.put(cache_key, answer)
+
+            yield "data: [DONE]\n\n"
+
+        except Exception:
+            logger.exception("RAG streaming query failed")
+            yield sse_event({"error": "Internal server error"})
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+
+@app.get("/health")
+async def health() -> ORJSONResponse:
+    """
+    Liveness plus a quick Chroma reachability check.
+
+    A slow Chroma Cloud round-trip is reported as a timeout without
+    failing the check; only an actual error returns 503.
+    """
+    try:
+        await asyncio.wait_for(
+            asyncio.to_thread(app.state.collection.count),
+            timeout=HEALTH_CHECK_TIMEOUT,
+        )
+    except asyncio.TimeoutError:
+        logger.warning("Health check: Chroma did not answer in time")
+        return ORJSONResponse(content={"status": "ok", "chroma": "timeout"})
+    except Exception:
+        logger.warning("Health check: Chroma unavailable", exc_info=True)
+        return ORJSONResponse(
+            status_code=503,
+            content={"status": "degraded", "chroma": "unavailable"},
+        )
+
+    return ORJSONResponse(content={"status": "ok", "chroma": "ok"})
+
+
+@app.get("/cache/stats")
+async def cache_stats() -> dict:
+    return query_cache.stats()
+
+
+@app.post("/cache/invalidate")
+async def cache_invalidate() -> dict:
+    """
+    Drop all cached answers. Call this after re-running ingestion.
+    """
+    generation = query_cache.invalidate()
+    logger.info("Query cache invalidated | generation=%s", generation)
+
+    return {"generation": generation}
+
+
 # ------------------------------------------------------------------
 # Local Dev Runner
 # ------------------------------------------------------------------
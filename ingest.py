@@ -2,13 +2,17 @@ import asyncio
 import os
 import hashlib
 import logging
-from typing import List, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, NamedTuple, Tuple
 
 from dotenv import load_dotenv
 from crawl4ai import AsyncWebCrawler, CrawlerRunConfig, CacheMode
 from crawl4ai.deep_crawling import BFSDeepCrawlStrategy
-from langchain_text_splitters import RecursiveCharacterTextSplitter
+from semantic_text_splitter import MarkdownSplitter
+import tiktoken
+from fastembed import TextEmbedding
 import chromadb
+import requests
 
 
 # ------------------------------------------------------------------
@@ -18,19 +22,47 @@ import chromadb
 load_dotenv()
 
 COLLECTION_NAME = "netweb_knowledge_base"
+EMBEDDING_MODEL = "BAAI/bge-small-en-v1.5"
 
 MAX_BYTES = 15_800
-UPSERT_BATCH_SIZE = 25
+# bge-small truncates input at 512 WordPiece tokens. 400 cl100k tokens
+# plus the source header usually fits; URL- or code-heavy markdown can
+# still run over and lose its tail to truncation.
+CHUNK_TOKENS = 400
+CHUNK_OVERLAP_TOKENS = 40
+MIN_CHUNK_TOKENS = 50
+UPSERT_BATCH_SIZE = 200
+UPSERT_WORKERS = 4
+ID_LOOKUP_BATCH_SIZE = 1000
+EMBED_BATCH_SIZE = 256
 
 CRAWL_MAX_DEPTH = 2
 CRAWL_MAX_PAGES = 30
 
-TEXT_SPLITTER = RecursiveCharacterTextSplitter(
-    chunk_size=4000,
-    chunk_overlap=300,
-    separators=["\n# ", "\n## ", "\n\n", ". "],
+# The running API caches answers; ingest clears that cache when done
+API_BASE_URL = "http://localhost:8000"
+CACHE_INVALIDATE_ENDPOINT = f"{API_BASE_URL}/cache/invalidate"
+CACHE_INVALIDATE_TIMEOUT = 5  # seconds
+
+PROCESS_WORKERS = os.cpu_count() or 1
+QUEUE_MAX_SIZE = 64
+
+# cl100k_base is only a sizing proxy for bge's WordPiece window; loaded
+# once per process since building the BPE table is expensive
+TOKEN_ENCODING = tiktoken.get_encoding("cl100k_base")
+
+# Rust-backed splitter; splits on markdown headings, then paragraphs,
+# then sentences, like the previous separator list. "gpt-4" selects
+# the same cl100k_base tokenizer for sizing.
+TEXT_SPLITTER = MarkdownSplitter.from_tiktoken_model(
+    "gpt-4",
+    CHUNK_TOKENS,
+    overlap=CHUNK_OVERLAP_TOKENS,
 )
 
+CHUNK_SEPARATOR = "\n\n"
+RESPLIT_SEPARATORS = ["\n# ", "\n## ", "\n\n", ". "]
+
 
 # ------------------------------------------------------------------
 # Logging
@@ -50,20 +82,162 @@ logger = logging.getLogger("kb-ingestion")
 # Utility Functions
 # ------------------------------------------------------------------
 
-def compute_hash(text: str) -> str:
-    return hashlib.md5(text.encode("utf-8")).hexdigest()
+def compute_hash(header: bytes, data: bytes) -> str:
+    # Hash exactly what gets stored (page header + chunk) so a title
+    # change yields a new ID; 16-byte digest keeps IDs at 32 hex chars
+    digest = hashlib.blake2b(header, digest_size=16)
+    digest.update(data)
+    return digest.hexdigest()
+
+
+def count_tokens(text: str) -> int:
+    # encode_ordinary skips special-token checks, which crawled text
+    # could otherwise trip
+    return len(TOKEN_ENCODING.encode_ordinary(text))
+
+
+def merge_small(
+    chunks: List[Tuple[str, bytes]],
+    min_tokens: int,
+    max_tokens: int,
+    max_bytes: int,
+) -> List[Tuple[str, bytes]]:
+    """
+    Greedily fold chunks under min_tokens into their neighbour, as long
+    as the merged chunk stays within max_tokens and max_bytes.
+    """
+    separator = CHUNK_SEPARATOR.encode("utf-8")
+    separator_tokens = count_tokens(CHUNK_SEPARATOR)
+
+    merged: List[Tuple[str, bytes]] = []
+    merged_tokens: List[int] = []
+
+    for text, data in chunks:
+        tokens = count_tokens(text)
+
+        if merged:
+            prev_text, prev_data = merged[-1]
+            prev_tokens = merged_tokens[-1]
+
+            is_small = prev_tokens < min_tokens or tokens < min_tokens
+            fits = (
+                prev_tokens + separator_tokens + tokens <= max_tokens
+                and len(prev_data) + len(separator) + len(data) <= max_bytes
+            )
+
+            if is_small and fits:
+                merged[-1] = (
+                    prev_text + CHUNK_SEPARATOR + text,
+                    prev_data + separator + data,
+                )
+                merged_tokens[-1] = prev_tokens + separator_tokens + tokens
+                continue
+
+        merged.append((text, data))
+        merged_tokens.append(tokens)
+
+    return merged
+
+
+def _hard_split(data: bytes, max_bytes: int) -> List[Tuple[str, bytes]]:
+    pieces: List[Tuple[str, bytes]] = []
+    start = 0
+
+    while start < len(data):
+        end = min(start + max_bytes, len(data))
+
+        # Never cut inside a multi-byte UTF-8 sequence
+        while end < len(data) and (data[end] & 0xC0) == 0x80:
+            end -= 1
+
+        piece = data[start:end]
+        pieces.append((piece.decode("utf-8"), piece))
+        start = end
+
+    return pieces
+
+
+def _split_oversized(
+    text: str,
+    data: bytes,
+    max_bytes: int,
+    separators: List[str],
+) -> List[Tuple[str, bytes]]:
+    if len(data) <= max_bytes:
+        return [(text, data)]
 
+    if not separators:
+        return _hard_split(data, max_bytes)
 
-def split_if_needed(text: str) -> List[str]:
-    byte_size = len(text.encode("utf-8"))
+    separator, remaining = separators[0], separators[1:]
+    parts = text.split(separator)
 
-    if byte_size <= MAX_BYTES:
-        return [text]
+    if len(parts) == 1:
+        return _split_oversized(text, data, max_bytes, remaining)
 
-    return TEXT_SPLITTER.split_text(text)
+    separator_size = len(separator.encode("utf-8"))
+    groups: List[List[str]] = [[]]
+    group_size = 0
 
+    for part in parts:
+        part_size = len(part.encode("utf-8"))
+        added = part_size + (separator_size if groups[-1] else 0)
 
-def validate_chroma_env() -> None:
+        if groups[-1] and group_size + added > max_bytes:
+            groups.append([])
+            group_size = 0
+            added = part_size
+
+        groups[-1].append(part)
+        group_size += added
+
+    pieces: List[Tuple[str, bytes]] = []
+    for group in groups:
+        piece = separator.join(group)
+        pieces.extend(
+            _split_oversized(piece, piece.encode("utf-8"), max_bytes, remaining)
+        )
+
+    return pieces
+
+
+def resplit_large(
+    chunks: List[Tuple[str, bytes]],
+    max_bytes: int,
+) -> List[Tuple[str, bytes]]:
+    """
+    Re-split any chunk over max_bytes (Chroma's document size limit)
+    using the separator cascade, falling back to a hard byte cut.
+    """
+    resplit: List[Tuple[str, bytes]] = []
+
+    for text, data in chunks:
+        resplit.extend(
+            _split_oversized(text, data, max_bytes, RESPLIT_SEPARATORS)
+        )
+
+    return resplit
+
+
+def split_if_needed(text: str) -> List[Tuple[str, bytes]]:
+    """
+    Return (chunk, utf-8 bytes) pairs so callers never re-encode.
+    """
+    data = text.encode("utf-8")
+
+    if len(data) <= MAX_BYTES and count_tokens(text) <= CHUNK_TOKENS:
+        return [(text, data)]
+
+    chunks = [
+        (chunk, chunk.encode("utf-8"))
+        for chunk in TEXT_SPLITTER.chunks(text)
+    ]
+    chunks = merge_small(chunks, MIN_CHUNK_TOKENS, CHUNK_TOKENS, MAX_BYTES)
+
+    return resplit_large(chunks, MAX_BYTES)
+
+
+def validate_env() -> None:
     required_vars = [
         "CHROMA_API_KEY",
         "CHROMA_TENANT",
@@ -79,7 +253,7 @@ def validate_chroma_env() -> None:
 # Crawling
 # ------------------------------------------------------------------
 
-async def crawl_site(url: str):
+async def crawl_site(url: str, queue_raw: asyncio.Queue) -> None:
     logger.info("Starting crawl | url=%s depth=%s pages=%s",
                 url, CRAWL_MAX_DEPTH, CRAWL_MAX_PAGES)
 
@@ -88,85 +262,136 @@ async def crawl_site(url: str):
         max_pages=CRAWL_MAX_PAGES,
     )
 
+    # Stream pages as they are fetched so processing starts immediately
     config = CrawlerRunConfig(
         deep_crawl_strategy=strategy,
         cache_mode=CacheMode.ENABLED,
+        stream=True,
     )
 
-    async with AsyncWebCrawler() as crawler:
-        results = await crawler.arun(url=url, config=config)
+    pages_fetched = 0
 
-    result_list = results if isinstance(results, list) else [results]
-    logger.info("Crawl completed | pages_fetched=%s", len(result_list))
+    async with AsyncWebCrawler() as crawler:
+        async for result in await crawler.arun(url=url, config=config):
+            await queue_raw.put(result)
+            pages_fetched += 1
 
-    return result_list
+    logger.info("Crawl completed | pages_fetched=%s", pages_fetched)
 
 
 # ------------------------------------------------------------------
 # Document Processing
 # ------------------------------------------------------------------
 
-def extract_documents(results) -> Tuple[List[str], List[dict], List[str]]:
-    documents: List[str] = []
-    metadatas: List[dict] = []
-    ids: List[str] = []
+class Chunk(NamedTuple):
+    document: str
+    metadata: dict
+    id: str
 
-    seen_ids = set()
 
-    for result in results:
-        if not result.success or not result.markdown:
-            logger.warning("Skipping failed page | url=%s", result.url)
-            continue
+def extract_documents(result) -> List[Chunk]:
+    if not result.success or not result.markdown:
+        logger.warning("Skipping failed page | url=%s", result.url)
+        return []
 
-        chunks = split_if_needed(result.markdown)
-        title = result.metadata.get("title", "Webpage")
+    chunks = split_if_needed(result.markdown)
+    url = result.url
+    title = result.metadata.get("title", "Webpage")
 
-        logger.info(
-            "Processing page | url=%s chunks=%s",
-            result.url,
-            len(chunks),
+    logger.info(
+        "Processing page | url=%s chunks=%s",
+        url,
+        len(chunks),
+    )
+
+    # Per-page values are built once and shared by every chunk;
+    # Chroma only serializes the metadata, so sharing the dict is safe
+    header = (
+        f"Source: {title}\n"
+        f"URL: {url}\n\n"
+    )
+    metadata = {
+        "source": url,
+        "title": title,
+    }
+    header_bytes = header.encode("utf-8")
+    id_prefix = f"{url}#"
+
+    return [
+        Chunk(
+            header + chunk,
+            metadata,
+            id_prefix + compute_hash(header_bytes, data),
+        )
+        for chunk, data in chunks
+    ]
+
+
+async def process_pages(
+    queue_raw: asyncio.Queue,
+    queue_upsert: asyncio.Queue,
+    executor: ThreadPoolExecutor,
+) -> None:
+    loop = asyncio.get_running_loop()
+
+    while True:
+        result = await queue_raw.get()
+        if result is None:
+            return
+
+        # Splitting and hashing run off the loop so crawling continues.
+        # A thread pool rather than a process pool avoids pickling each
+        # crawl result across process boundaries.
+        chunks = await loop.run_in_executor(
+            executor,
+            extract_documents,
+            result,
         )
 
         for chunk in chunks:
-            content_hash = compute_hash(chunk)
-            chunk_id = f"{result.url}#{content_hash}"
+            await queue_upsert.put(chunk)
 
-            if chunk_id in seen_ids:
-                logger.debug("Duplicate chunk skipped | id=%s", chunk_id)
-                continue
 
-            doc_text = (
-                f"Source: {title}\n"
-                f"URL: {result.url}\n\n"
-                f"{chunk}"
-            )
+# ------------------------------------------------------------------
+# Persistence
+# ------------------------------------------------------------------
 
-            documents.append(doc_text)
-            metadatas.append({
-                "source": result.url,
-                "title": title,
-            })
-            ids.append(chunk_id)
-            seen_ids.add(chunk_id)
+def embed_batch(
+    embedding_model: TextEmbedding,
+    texts: List[str],
+) -> List[List[float]]:
+    return [
+        vector.tolist()
+        for vector in embedding_model.passage_embed(
+            texts,
+            batch_size=EMBED_BATCH_SIZE,
+        )
+    ]
 
-    logger.info(
-        "Document extraction completed | documents=%s",
-        len(documents),
-    )
 
-    return documents, metadatas, ids
+def fetch_existing_ids(collection, ids: List[str]) -> set:
+    existing = set()
 
+    for i in range(0, len(ids), ID_LOOKUP_BATCH_SIZE):
+        found = collection.get(ids=ids[i:i + ID_LOOKUP_BATCH_SIZE], include=[])
+        existing.update(found["ids"])
 
-# ------------------------------------------------------------------
-# Persistence
-# ------------------------------------------------------------------
+    return existing
 
-def upsert_to_chroma(
-    documents: List[str],
-    metadatas: List[dict],
-    ids: List[str],
-) -> None:
-    validate_chroma_env()
+
+def validate_collection(collection: chromadb.Collection) -> None:
+    stored_model = (collection.metadata or {}).get("embedding_model")
+
+    if stored_model != EMBEDDING_MODEL:
+        raise RuntimeError(
+            f"Collection '{COLLECTION_NAME}' was embedded with "
+            f"{stored_model or 'an unrecorded model'}, expected "
+            f"{EMBEDDING_MODEL}. Delete the collection and re-run ingestion."
+        )
+
+
+def connect_chroma() -> Tuple[chromadb.CloudClient, chromadb.Collection]:
+    validate_env()
 
     logger.info("Connecting to Chroma Cloud")
 
@@ -176,19 +401,134 @@ def upsert_to_chroma(
         database=os.getenv("CHROMA_DATABASE"),
     )
 
-    collection = client.get_or_create_collection(name=COLLECTION_NAME)
+    # Record the embedding model so vectors from different models are
+    # never mixed; a new collection is stamped here
+    collection = client.get_or_create_collection(
+        name=COLLECTION_NAME,
+        metadata={"embedding_model": EMBEDDING_MODEL},
+    )
+    validate_collection(collection)
+
+    return client, collection
 
-    for i in range(0, len(documents), UPSERT_BATCH_SIZE):
-        batch_size = len(documents[i:i + UPSERT_BATCH_SIZE])
-        logger.info("Upserting batch | size=%s", batch_size)
 
-        collection.upsert(
-            documents=documents[i:i + UPSERT_BATCH_SIZE],
-            metadatas=metadatas[i:i + UPSERT_BATCH_SIZE],
-            ids=ids[i:i + UPSERT_BATCH_SIZE],
+def upsert_batch(
+    collection: chromadb.Collection,
+    embedding_model: TextEmbedding,
+    batch: List[Chunk],
+) -> int:
+    # IDs hash the stored document (page header + chunk), so an existing
+    # ID means the row's text, title and embedding input are unchanged
+    existing = fetch_existing_ids(collection, [chunk.id for chunk in batch])
+    if existing:
+        batch = [chunk for chunk in batch if chunk.id not in existing]
+
+        logger.info(
+            "Skipping unchanged chunks | existing=%s new=%s",
+            len(existing),
+            len(batch),
         )
 
-    logger.info("Upsert completed | collection=%s", COLLECTION_NAME)
+    if not batch:
+        return 0
+
+    # Unzip once into the parallel lists Chroma expects
+    documents, metadatas, ids = map(list, zip(*batch))
+
+    logger.info("Upserting batch | size=%s", len(ids))
+
+    collection.upsert(
+        embeddings=embed_batch(embedding_model, documents),
+        documents=documents,
+        metadatas=metadatas,
+        ids=ids,
+    )
+
+    return len(ids)
+
+
+async def upsert_documents(
+    queue_upsert: asyncio.Queue,
+    collection: chromadb.Collection,
+    embedding_model: TextEmbedding,
+    batch_size: int,
+) -> Tuple[int, int]:
+    """
+    Accumulate chunks into batches and upsert them in worker threads,
+    with at most UPSERT_WORKERS batches in flight.
+
+    Returns (documents extracted, documents upserted).
+    """
+    semaphore = asyncio.Semaphore(UPSERT_WORKERS)
+    tasks: List[asyncio.Task] = []
+
+    async def run_batch(items: List[Chunk]) -> int:
+        try:
+            return await asyncio.to_thread(
+                upsert_batch, collection, embedding_model, items,
+            )
+        finally:
+            semaphore.release()
+
+    async def flush(items: List[Chunk]) -> None:
+        await semaphore.acquire()
+        tasks.append(asyncio.create_task(run_batch(items)))
+
+    seen_ids = set()
+    batch: List[Chunk] = []
+
+    while True:
+        item = await queue_upsert.get()
+        if item is None:
+            break
+
+        if item.id in seen_ids:
+            logger.debug("Duplicate chunk skipped | id=%s", item.id)
+            continue
+
+        seen_ids.add(item.id)
+        batch.append(item)
+
+        if len(batch) >= batch_size:
+            await flush(batch)
+            batch = []
+
+    if batch:
+        await flush(batch)
+
+    upserted = sum(await asyncio.gather(*tasks))
+
+    logger.info(
+        "Document extraction completed | documents=%s",
+        len(seen_ids),
+    )
+    logger.info(
+        "Upsert completed | collection=%s upserted=%s",
+        COLLECTION_NAME,
+        upserted,
+    )
+
+    return len(seen_ids), upserted
+
+
+def invalidate_api_cache() -> None:
+    """
+    Best effort: the API may not be running while ingesting.
+    """
+    try:
+        response = requests.post(
+            CACHE_INVALIDATE_ENDPOINT,
+            timeout=CACHE_INVALIDATE_TIMEOUT,
+        )
+        response.raise_for_status()
+        logger.info("API answer cache invalidated")
+
+    except requests.exceptions.RequestException as exc:
+        logger.warning(
+            "Could not invalidate API answer cache | url=%s error=%s",
+            CACHE_INVALIDATE_ENDPOINT,
+            exc,
+        )
 
 
 # ------------------------------------------------------------------
@@ -200,20 +540,55 @@ async def main(url: str) -> None:
 
     logger.info("KB ingestion started")
 
-    results = await crawl_site(url)
-    documents, metadatas, ids = extract_documents(results)
-
-    if not documents:
-        logger.warning("No documents extracted | exiting")
-        return
+    client, collection = connect_chroma()
+    # Must match the model api.py embeds queries with
+    embedding_model = TextEmbedding(model_name=EMBEDDING_MODEL)
+
+    batch_size = UPSERT_BATCH_SIZE
+    if hasattr(client, "get_max_batch_size"):
+        batch_size = min(batch_size, client.get_max_batch_size())
+
+    # Bounded queues apply backpressure between stages
+    queue_raw: asyncio.Queue = asyncio.Queue(maxsize=QUEUE_MAX_SIZE)
+    queue_upsert: asyncio.Queue = asyncio.Queue(maxsize=batch_size * 2)
+
+    async def crawl_stage() -> None:
+        try:
+            await crawl_site(url, queue_raw)
+        finally:
+            for _ in range(PROCESS_WORKERS):
+                await queue_raw.put(None)
+
+    async def process_stage() -> None:
+        try:
+            with ThreadPoolExecutor(max_workers=PROCESS_WORKERS) as executor:
+                await asyncio.gather(*(
+                    process_pages(queue_raw, queue_upsert, executor)
+                    for _ in range(PROCESS_WORKERS)
+                ))
+        finally:
+            await queue_upsert.put(None)
 
     try:
-        upsert_to_chroma(documents, metadatas, ids)
-        logger.info("KB ingestion successful")
+        _, _, (documents, upserted) = await asyncio.gather(
+            crawl_stage(),
+            process_stage(),
+            upsert_documents(queue_upsert, collection, embedding_model, batch_size),
+        )
     except Exception as exc:
         logger.exception("KB ingestion failed")
         raise exc
 
+    if not documents:
+        logger.warning("No documents extracted")
+        return
+
+    # Cached answers may be stale only if the knowledge base changed
+    if upserted:
+        invalidate_api_cache()
+
+    logger.info("KB ingestion successful")
+
 
 if __name__ == "__main__":
     asyncio.run(main("https://netweb.biz"))
@@ -0,0 +1,92 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+
+# ------------------------------------------------------------------
+# Configuration
+# ------------------------------------------------------------------
+
+DEFAULT_TTL_SECONDS = 300
+DEFAULT_MAX_SIZE = 1000
+
+
+# ------------------------------------------------------------------
+# Query Cache
+# ------------------------------------------------------------------
+
+class QueryCache:
+    """
+    Thread-safe LRU cache with TTL expiry for generated answers.
+
+    Keys embed a generation counter, so invalidate() drops every
+    existing entry at once (e.g. after the knowledge base is re-ingested).
+    """
+
+    def __init__(
+        self,
+        ttl_seconds: int = DEFAULT_TTL_SECONDS,
+        max_size: int = DEFAULT_MAX_SIZE,
+    ) -> None:
+        self.ttl_seconds = ttl_seconds
+        self.max_size = max_size
+
+        self._entries: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._lock = threading.RLock()
+        self._generation = 0
+        self._hits = 0
+        self._misses = 0
+
+    def make_key(self, question: str, top_k: int) -> str:
+        digest = hashlib.blake2b(question.strip().lower().encode("utf-8")).hexdigest()
+        with self._lock:
+            return f"{self._generation}:{top_k}:{digest}"
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None:
+                self._misses += 1
+                return None
+
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                self._misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return value
+
+    def put(self, key: str, value: str) -> None:
+        with self._lock:
+            # Drop answers computed against an older generation
+            if not key.startswith(f"{self._generation}:"):
+                return
+
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self) -> int:
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            return self._generation
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "ttl_seconds": self.ttl_seconds,
+                "generation": self._generation,
+                "hits": self._hits,
+                "misses": self._misses,
+            }
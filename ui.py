@@ -1,8 +1,11 @@
+import itertools
 import logging
-from typing import Dict
+from typing import Dict, Iterator, Optional
 
+import orjson
 import requests
 import streamlit as st
+from requests.adapters import HTTPAdapter
 
 
 # ------------------------------------------------------------------
@@ -13,10 +16,11 @@ APP_TITLE = "NIA – RAG Explorer"
 APP_ICON = "🤖"
 
 API_BASE_URL = "http://localhost:8000"
-QUERY_ENDPOINT = f"{API_BASE_URL}/query"
+QUERY_ENDPOINT = f"{API_BASE_URL}/query/stream"
 HEALTH_ENDPOINT = f"{API_BASE_URL}/health"
 
 REQUEST_TIMEOUT = 30  # seconds
+HTTP_POOL_SIZE = 4
 
 
 # ------------------------------------------------------------------
@@ -39,6 +43,24 @@ st.title("NIA")
 st.markdown("Ask questions based on your ingested knowledge base.")
 
 
+# ------------------------------------------------------------------
+# HTTP Session
+# ------------------------------------------------------------------
+
+# Reuse keep-alive connections to the backend across reruns
+if "http" not in st.session_state:
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=HTTP_POOL_SIZE,
+        pool_maxsize=HTTP_POOL_SIZE,
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    st.session_state.http = session
+
+http: requests.Session = st.session_state.http
+
+
 # ------------------------------------------------------------------
 # Sidebar
 # ------------------------------------------------------------------
@@ -48,7 +70,7 @@ with st.sidebar:
 
     if st.button("Check Backend Status"):
         try:
-            response = requests.get(
+            response = http.get(
                 HEALTH_ENDPOINT,
                 timeout=5,
             )
@@ -63,6 +85,56 @@ with st.sidebar:
             st.error("Backend unreachable. Is the API running?")
 
 
+# ------------------------------------------------------------------
+# Streaming
+# ------------------------------------------------------------------
+
+class BackendStreamError(RuntimeError):
+    """Raised when the backend reports a failure mid-stream."""
+
+
+def iter_answer_deltas(response: requests.Response) -> Iterator[str]:
+    """
+    Yield answer text from the backend's Server-Sent Events stream.
+
+    Keeps reading after the final event: abandoning iter_lines early
+    makes urllib3 close the socket instead of returning it to the pool.
+    Raises BackendStreamError once the body is drained if the backend
+    sent an error event.
+    """
+    finished = False
+    error: Optional[str] = None
+
+    for line in response.iter_lines(decode_unicode=True):
+        if finished or not line or not line.startswith("data: "):
+            continue
+
+        payload = line[len("data: "):]
+        if payload == "[DONE]":
+            finished = True
+            continue
+
+        event = orjson.loads(payload)
+        if "error" in event:
+            error = event["error"]
+            finished = True
+            continue
+
+        yield event.get("delta", "")
+
+    if error is not None:
+        raise BackendStreamError(error)
+
+
+def release_response(response: requests.Response) -> None:
+    """
+    Read whatever body is left (e.g. the chunked terminator after
+    [DONE]) so urllib3 returns the connection to the session's pool.
+    """
+    response.raw.drain_conn()
+    response.raw.release_conn()
+
+
 # ------------------------------------------------------------------
 # Session State
 # ------------------------------------------------------------------
@@ -98,12 +170,15 @@ if prompt := st.chat_input("What would you like to know?"):
 
     # Assistant response
     with st.chat_message("assistant"):
-        with st.spinner("Thinking..."):
-            try:
-                response = requests.post(
+        response = None
+
+        try:
+            with st.spinner("Thinking..."):
+                response = http.post(
                     QUERY_ENDPOINT,
                     json={"question": prompt},
                     timeout=REQUEST_TIMEOUT,
+                    stream=True,
                 )
 
                 if response.status_code != 200:
@@ -115,23 +190,40 @@ if prompt := st.chat_input("What would you like to know?"):
                     st.error("Failed to get response from backend.")
                     st.stop()
 
-                answer = response.json().get(
-                    "answer",
-                    "No answer returned by the backend.",
-                )
+                # Headers arrive before retrieval runs; keep the spinner
+                # up until the first token is generated
+                deltas = iter_answer_deltas(response)
+                first_delta = next(deltas, None)
+
+            if first_delta is None:
+                st.error("Failed to get response from backend.")
+                st.stop()
+
+            answer = st.write_stream(itertools.chain([first_delta], deltas))
+
+            if not answer:
+                st.error("Failed to get response from backend.")
+                st.stop()
 
-                st.markdown(answer)
-                st.session_state.messages.append({
-                    "role": "assistant",
-                    "content": answer,
-                })
+            st.session_state.messages.append({
+                "role": "assistant",
+                "content": answer,
+            })
 
-                logger.info("Answer displayed successfully")
+            logger.info("Answer displayed successfully")
 
-            except requests.exceptions.Timeout:
-                logger.error("API request timed out")
-                st.error("Request timed out. Please try again.")
+        except BackendStreamError as exc:
+            logger.error("Backend stream failed | error=%s", exc)
+            st.error("The backend failed while generating the answer.")
+
+        except requests.exceptions.Timeout:
+            logger.error("API request timed out")
+            st.error("Request timed out. Please try again.")
+
+        except requests.exceptions.RequestException as exc:
+            logger.exception("API request failed")
+            st.error("Connection failed. Please check backend logs.")
 
-            except requests.exceptions.RequestException as exc:
-                logger.exception("API request failed")
-                st.error("Connection failed. Please check backend logs.")
+        finally:
+            if response is not None:
+                release_response(response)